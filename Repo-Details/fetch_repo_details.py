@@ -1,21 +1,65 @@
 import requests
-import csv
 import time
 import logging
+import queue
+import atexit
 import os
+import orjson
+import numpy as np
+from operator import itemgetter
+from itertools import chain
+from collections import namedtuple
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from logging.handlers import QueueHandler, QueueListener
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # Load environment variables
 load_dotenv()
 GITHUB_URL = os.getenv('GITHUB_URL')
 ORG_NAME = os.getenv('ORG_NAME')
 TOKEN = os.getenv('GITHUB_TOKEN')
+OUTPUT_PARQUET = os.getenv('OUTPUT_PARQUET')
 
-# Logging setup
+# Optional Parquet output, written in row groups alongside the CSV
+if OUTPUT_PARQUET:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    PARQUET_FILE = f"{ORG_NAME}_repository_details.parquet"
+    PARQUET_SCHEMA = pa.schema([
+        ("repo_name", pa.string()),
+        ("repo_size_mb", pa.float64()),
+        ("visibility", pa.string()),
+        ("total_commits", pa.int64()),
+        ("total_branches", pa.int64()),
+        ("open_prs", pa.int64()),
+        ("merged_prs", pa.int64()),
+        ("closed_prs", pa.int64()),
+        ("open_issues", pa.int64()),
+        ("closed_issues", pa.int64()),
+        ("releases", pa.int64()),
+        ("tags", pa.int64()),
+        ("languages", pa.string()),
+        ("last_pushed_at", pa.string()),
+        ("last_updated_at", pa.string()),
+    ])
+
+# Logging setup: records are queued and written to the file by a background thread
 if not os.path.exists('logs'):
     os.makedirs('logs')
-logging.basicConfig(filename='logs/repo_fetch.log', level=logging.INFO,
-                    format='%(asctime)s:%(levelname)s:%(message)s')
+file_handler = logging.FileHandler('logs/repo_fetch.log')
+file_handler.setFormatter(logging.Formatter('%(asctime)s:%(levelname)s:%(message)s'))
+log_queue = queue.Queue(-1)
+root_logger = logging.getLogger()
+root_logger.setLevel(logging.INFO)
+root_logger.addHandler(QueueHandler(log_queue))
+log_listener = QueueListener(log_queue, file_handler)
+log_listener.start()
+atexit.register(log_listener.stop)
 
 # API endpoint setup
 if "github.com" in GITHUB_URL:
@@ -25,14 +69,32 @@ else:
 
 headers = {
     "Authorization": f"Bearer {TOKEN}",
-    "Accept": "application/vnd.github+json"
+    "Accept": "application/vnd.github+json",
+    "Content-Type": "application/json"
 }
 
-# Updated GraphQL query with aliases for refs
-query = """
+# Shared session so every page reuses the same pooled TLS connection
+SESSION = requests.Session()
+SESSION.headers.update(headers)
+retry_strategy = Retry(
+    total=5,
+    backoff_factor=1,
+    status_forcelist=[429, 500, 502, 503, 504],
+    allowed_methods=["POST"],
+    respect_retry_after_header=True,
+)
+SESSION.mount("https://", HTTPAdapter(max_retries=retry_strategy, pool_connections=1, pool_maxsize=4))
+
+# Core GraphQL query: per-repo fields that can change without a push, fetched for every repository
+query_core = """
 query($org: String!, $cursor: String) {
+  rateLimit {
+    cost
+    remaining
+    resetAt
+  }
   organization(login: $org) {
-    repositories(first: 50, after: $cursor) {
+    repositories(first: 100, after: $cursor) {
       pageInfo {
         hasNextPage
         endCursor
@@ -50,9 +112,6 @@ query($org: String!, $cursor: String) {
             }
           }
         }
-        branches: refs(refPrefix: "refs/heads/") {
-          totalCount
-        }
         pullRequests(states: OPEN) {
           totalCount
         }
@@ -68,12 +127,6 @@ query($org: String!, $cursor: String) {
         closedIssues: issues(states: CLOSED) {
           totalCount
         }
-        releases {
-          totalCount
-        }
-        tags: refs(refPrefix: "refs/tags/") {
-          totalCount
-        }
         languages(first: 5) {
           nodes {
             name
@@ -87,92 +140,261 @@ query($org: String!, $cursor: String) {
 }
 """
 
-def fetch_data():
+# Counts GraphQL query: ref and release counts, which only change on a push, so they are
+# only fetched for repositories pushed to since the last run.
+# %s is replaced by aliased repository selections.
+query_counts = """
+query($org: String!) {
+  rateLimit {
+    cost
+    remaining
+    resetAt
+  }
+%s
+}
+
+fragment RepoCounts on Repository {
+  branches: refs(refPrefix: "refs/heads/") {
+    totalCount
+  }
+  releases {
+    totalCount
+  }
+  tags: refs(refPrefix: "refs/tags/") {
+    totalCount
+  }
+}
+"""
+
+# One row per repository; disk usage stays in KB until the page is written
+Repo = namedtuple('Repo', [
+    "repo_name", "disk_kb", "visibility", "total_commits", "total_branches",
+    "open_prs", "merged_prs", "closed_prs", "open_issues", "closed_issues",
+    "releases", "tags", "languages", "last_pushed_at", "last_updated_at"
+])
+# CSV columns, in Repo field order
+KEYS = ["repo_name", "repo_size_mb", *Repo._fields[2:]]
+
+_name = itemgetter('name')
+_counts = itemgetter("total_branches", "releases", "tags")
+
+# Sidecar cache of counts from previous runs, keyed by repository name
+COUNTS_CACHE_FILE = f"{ORG_NAME}_repo_counts.json"
+
+def load_counts_cache():
+    if not os.path.exists(COUNTS_CACHE_FILE):
+        return {}
+    try:
+        with open(COUNTS_CACHE_FILE, "rb") as f:
+            return orjson.loads(f.read())
+    except (OSError, ValueError) as e:
+        logging.warning(f"Ignoring unreadable counts cache '{COUNTS_CACHE_FILE}': {str(e)}")
+        return {}
+
+def save_counts_cache(cache):
+    with open(COUNTS_CACHE_FILE, "wb") as f:
+        f.write(orjson.dumps(cache))
+
+def fetch_counts(names):
+    """Fetch branch, release and tag counts for the given repositories.
+
+    Returns the counts keyed by repository name, and the query's rateLimit. Repositories
+    that come back null (renamed, deleted or hidden since the page was read) are left out.
+    """
+    selections = "\n".join(
+        f"  r{i}: repository(owner: $org, name: {orjson.dumps(name).decode()}) {{ ...RepoCounts }}"
+        for i, name in enumerate(names)
+    )
+    variables = {"org": ORG_NAME}
+    response = SESSION.post(API_URL, data=orjson.dumps({'query': query_counts % selections, 'variables': variables}), timeout=30)
+    if response.status_code != 200:
+        raise Exception(f"HTTP error {response.status_code} fetching counts: {response.text}")
+
+    json_data = orjson.loads(response.content)
+    data = json_data.get('data')
+    if not data:
+        raise Exception(f"GraphQL errors fetching counts: {json_data.get('errors')}")
+    if 'errors' in json_data:
+        logging.warning(f"Partial GraphQL errors fetching counts: {json_data['errors']}")
+
+    counts = {}
+    for i, name in enumerate(names):
+        repo = data.get(f"r{i}")
+        if repo is None:
+            logging.warning(f"No counts returned for repository '{name}'")
+            continue
+        counts[name] = {
+            "total_branches": repo['branches']['totalCount'],
+            "releases": repo['releases']['totalCount'],
+            "tags": repo['tags']['totalCount']
+        }
+    return counts, data.get('rateLimit')
+
+def iter_repo_pages():
+    """Yield a list of Repo rows for each GraphQL page as it arrives."""
     has_next_page = True
     cursor = None
-    repo_data = []
-
-    while has_next_page:
-        try:
-            variables = {"org": ORG_NAME, "cursor": cursor}
-            response = requests.post(API_URL, json={'query': query, 'variables': variables}, headers=headers)
-
-            if response.status_code == 200:
-                json_data = response.json()
-                if 'errors' in json_data:
-                    logging.error(f"GraphQL errors: {json_data['errors']}")
-                    print(f"Error: {json_data['errors']}")
+    counts_cache = load_counts_cache()
+
+    try:
+        while has_next_page:
+            try:
+                variables = {"org": ORG_NAME, "cursor": cursor}
+                response = SESSION.post(API_URL, data=orjson.dumps({'query': query_core, 'variables': variables}), timeout=30)
+
+                if response.status_code == 200:
+                    json_data = orjson.loads(response.content)
+                    if 'errors' in json_data:
+                        logging.error(f"GraphQL errors: {json_data['errors']}")
+                        print(f"Error: {json_data['errors']}")
+                        break
+
+                    repos = json_data['data']['organization']['repositories']['nodes']
+                    page_info = json_data['data']['organization']['repositories']['pageInfo']
+
+                    # Only re-count repositories pushed to since the last run
+                    changed = [
+                        repo for repo in repos
+                        if repo['name'] not in counts_cache
+                        or counts_cache[repo['name']]['pushedAt'] != repo['pushedAt']
+                    ]
+                    # rateLimit is null when the instance has rate limiting disabled
+                    rate_limit = json_data['data']['rateLimit']
+                    page_cost = rate_limit['cost'] if rate_limit else 0
+                    if changed:
+                        page_counts, rate_limit = fetch_counts([repo['name'] for repo in changed])
+                        page_cost += rate_limit['cost'] if rate_limit else 0
+                        for repo in changed:
+                            if repo['name'] in page_counts:
+                                counts_cache[repo['name']] = {
+                                    "pushedAt": repo['pushedAt'],
+                                    "counts": page_counts[repo['name']]
+                                }
+                    logging.info(f"Fetched counts for {len(changed)} changed repositories, reused {len(repos) - len(changed)} from cache")
+
+                    has_next_page = page_info['hasNextPage']
+                    cursor = page_info['endCursor']
+
+                    logging.info(f"Fetched {len(repos)} repositories, has_next_page: {has_next_page}")
+                    print(f"Fetched {len(repos)} repositories...")
+
+                    page_rows = []
+                    for repo in repos:
+                        langs = repo['languages']['nodes']
+                        languages = ", ".join(map(_name, langs)) if langs else "N/A"
+                        default_ref = repo['defaultBranchRef']
+                        # Repositories the counts query skipped keep their last known counts, or 0
+                        cached = counts_cache.get(repo['name'])
+                        total_branches, releases, tags = _counts(cached['counts']) if cached else (0, 0, 0)
+                        page_rows.append(Repo(
+                            repo['name'],
+                            repo['diskUsage'],
+                            repo['visibility'],
+                            default_ref['target']['history']['totalCount'] if default_ref else 0,
+                            total_branches,
+                            repo['pullRequests']['totalCount'],
+                            repo['mergedPRs']['totalCount'],
+                            repo['closedPRs']['totalCount'],
+                            repo['issues']['totalCount'],
+                            repo['closedIssues']['totalCount'],
+                            releases,
+                            tags,
+                            languages,
+                            repo['pushedAt'],
+                            repo['updatedAt']
+                        ))
+                    yield page_rows
+
+                    # API Rate limiting: make sure the next page's point cost still fits the budget
+                    if rate_limit and rate_limit['remaining'] < page_cost + 10:
+                        reset_time = datetime.fromisoformat(rate_limit['resetAt'].replace('Z', '+00:00')).timestamp()
+                        wait_time = max(reset_time - time.time() + 5, 0)
+                        if wait_time > 0:
+                            logging.warning(f"Rate limit hit. Sleeping for {wait_time} seconds...")
+                            print(f"Rate limit hit. Sleeping for {wait_time} seconds...")
+                            time.sleep(wait_time)
+
+                else:
+                    logging.error(f"HTTP error {response.status_code}: {response.text}")
+                    print(f"HTTP Error {response.status_code}: {response.text}")
                     break
 
-                repos = json_data['data']['organization']['repositories']['nodes']
-                page_info = json_data['data']['organization']['repositories']['pageInfo']
-
-                for repo in repos:
-                    languages = ", ".join([lang['name'] for lang in repo['languages']['nodes']]) if repo['languages']['nodes'] else "N/A"
-                    repo_data.append({
-                        "repo_name": repo['name'],
-                        "repo_size_mb": round((repo['diskUsage'] or 0) / 1024, 2),
-                        "visibility": repo['visibility'],
-                        "total_commits": repo['defaultBranchRef']['target']['history']['totalCount'] if repo['defaultBranchRef'] else 0,
-                        "total_branches": repo['branches']['totalCount'],
-                        "open_prs": repo['pullRequests']['totalCount'],
-                        "merged_prs": repo['mergedPRs']['totalCount'],
-                        "closed_prs": repo['closedPRs']['totalCount'],
-                        "open_issues": repo['issues']['totalCount'],
-                        "closed_issues": repo['closedIssues']['totalCount'],
-                        "releases": repo['releases']['totalCount'],
-                        "tags": repo['tags']['totalCount'],
-                        "languages": languages,
-                        "last_pushed_at": repo['pushedAt'],
-                        "last_updated_at": repo['updatedAt']
-                    })
-
-                has_next_page = page_info['hasNextPage']
-                cursor = page_info['endCursor']
-
-                logging.info(f"Fetched {len(repos)} repositories, has_next_page: {has_next_page}")
-                print(f"Fetched {len(repos)} repositories...")
-
-                # API Rate limiting
-                remaining = int(response.headers.get('X-RateLimit-Remaining', 1))
-                if remaining < 10:
-                    reset_time = int(response.headers.get('X-RateLimit-Reset', time.time() + 60))
-                    wait_time = reset_time - time.time() + 5
-                    logging.warning(f"Rate limit hit. Sleeping for {wait_time} seconds...")
-                    print(f"Rate limit hit. Sleeping for {wait_time} seconds...")
-                    time.sleep(wait_time)
-
-            else:
-                logging.error(f"HTTP error {response.status_code}: {response.text}")
-                print(f"HTTP Error {response.status_code}: {response.text}")
+            except Exception as e:
+                logging.error(f"Exception: {str(e)}")
+                print(f"Exception occurred: {str(e)}")
                 break
+    finally:
+        save_counts_cache(counts_cache)
+
+# CSV row format; only languages can contain commas or quotes
+CSV_ROW_FORMAT = "%s,%.2f,%s,%d,%d,%d,%d,%d,%d,%d,%d,%d,\"%s\",%s,%s\r\n"
+
+def sizes_in_mb(rows):
+    """Convert a page's disk usage from KB to MB, rounded to two places, in one vectorized step."""
+    disk_kb = np.fromiter((row.disk_kb or 0 for row in rows), dtype=np.int64, count=len(rows))
+    return np.round(disk_kb / 1024, 2)
 
-        except Exception as e:
-            logging.error(f"Exception: {str(e)}")
-            print(f"Exception occurred: {str(e)}")
-            break
+def parquet_table(rows, sizes_mb):
+    """Build a Parquet table column by column from Repo tuples and their sizes in MB."""
+    columns = list(zip(*rows))
+    columns[1] = sizes_mb
+    arrays = [pa.array(column, type=field.type) for column, field in zip(columns, PARQUET_SCHEMA)]
+    return pa.Table.from_arrays(arrays, schema=PARQUET_SCHEMA)
 
-    return repo_data
+def write_csv(pages):
+    """Write pages of rows to the CSV (and Parquet, if enabled); return how many rows were written.
+
+    Each page is written on a background thread while the next page is being fetched.
+    """
+    pages = iter(pages)
+    first_page = next(pages, None)
+    if not first_page:
+        return 0
 
-def write_csv(data):
     filename = f"{ORG_NAME}_repository_details.csv"
-    keys = list(data[0].keys()) if data else []
-    with open(filename, "w", newline='') as f:
-        writer = csv.DictWriter(f, fieldnames=keys)
-        writer.writeheader()
-        for row in data:
-            writer.writerow(row)
+
+    def write_page(rows):
+        sizes_mb = sizes_in_mb(rows)
+        f.write("".join(
+            CSV_ROW_FORMAT % ((row.repo_name, size_mb) + row[2:12] + (
+                row.languages.replace('"', '""'),
+                row.last_pushed_at or "",
+                row.last_updated_at or ""
+            ))
+            for row, size_mb in zip(rows, sizes_mb)
+        ))
+        if parquet_writer and rows:
+            parquet_writer.write_table(parquet_table(rows, sizes_mb))
+
+    count = 0
+    # The Parquet writer is closed even if a write fails, so the file always gets its footer
+    parquet_context = pq.ParquetWriter(PARQUET_FILE, PARQUET_SCHEMA, compression='zstd') if OUTPUT_PARQUET else nullcontext()
+    with open(filename, "w", newline='', encoding='utf-8', buffering=1 << 20) as f, \
+            parquet_context as parquet_writer, \
+            ThreadPoolExecutor(max_workers=1) as executor:
+        f.write(",".join(KEYS) + "\r\n")
+        pending = None
+        for rows in chain((first_page,), pages):
+            # Wait for the previous page so at most one page is queued behind the writer
+            if pending:
+                pending.result()
+            pending = executor.submit(write_page, rows)
+            count += len(rows)
+        pending.result()
 
     print(f"CSV file '{filename}' created successfully.")
     logging.info(f"CSV file '{filename}' created.")
 
+    if OUTPUT_PARQUET:
+        print(f"Parquet file '{PARQUET_FILE}' created successfully.")
+        logging.info(f"Parquet file '{PARQUET_FILE}' created.")
+
+    return count
+
 if __name__ == "__main__":
     print("Starting to fetch repository details...")
     logging.info("Script started.")
-    repo_details = fetch_data()
-    if repo_details:
-        write_csv(repo_details)
-    else:
+    if not write_csv(iter_repo_pages()):
         print("No repository data fetched.")
         logging.warning("No repository data fetched.")
     logging.info("Script completed.")
@@ -1,12 +1,12 @@
-import requests
+import httpx
+import csv
 import os
-import base64
+import orjson
 import time
-import pandas as pd
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
-from requests.adapters import HTTPAdapter
-from requests.packages.urllib3.util.retry import Retry
 
 # Fix for Unicode output in Windows terminal
 sys.stdout.reconfigure(encoding='utf-8')
@@ -16,6 +16,13 @@ load_dotenv()
 GITHUB_TOKEN = os.getenv("GITHUB_TOKEN")
 GHES_URL = os.getenv("GHES_URL")  # Example: https://github.company.com/api/v3
 ORG_NAME = os.getenv("ORG_NAME")  # Example: Org-name
+MAX_WORKERS = int(os.getenv("MAX_WORKERS", "16"))  # Repository batches processed concurrently
+
+# GraphQL endpoint lives next to the REST API root
+if "api.github.com" in GHES_URL:
+    GRAPHQL_URL = "https://api.github.com/graphql"
+else:
+    GRAPHQL_URL = GHES_URL.rstrip("/").rsplit("/v3", 1)[0] + "/graphql"
 
 # Headers for authentication
 HEADERS = {
@@ -23,131 +30,350 @@ HEADERS = {
     "Accept": "application/vnd.github.v3+json"
 }
 
-# Create session with retry
-session = requests.Session()
-retry_strategy = Retry(
-    total=5,
-    backoff_factor=3,
-    status_forcelist=[500, 502, 503, 504],
-    allowed_methods=["GET"],
+# Shared HTTP/2 client: concurrent requests are multiplexed over one connection
+client = httpx.Client(
+    headers=HEADERS,
+    http2=True,
+    limits=httpx.Limits(max_keepalive_connections=MAX_WORKERS, max_connections=MAX_WORKERS),
+    timeout=30,
+    follow_redirects=True,
 )
-adapter = HTTPAdapter(max_retries=retry_strategy)
-session.mount("https://", adapter)
 
-def safe_request(url):
-    """Perform a GET request with retry logic."""
+# Branches and default-branch .gitattributes for a batch of repositories;
+# %s is replaced by aliased repository selections
+REPO_BATCH_QUERY = """
+query($owner: String!) {
+  rateLimit {
+    cost
+  }
+%s
+}
+
+fragment LfsDetails on Repository {
+  defaultBranchRef {
+    name
+    target {
+      ... on Commit {
+        file(path: ".gitattributes") {
+          object {
+            ... on Blob {
+              text
+            }
+          }
+        }
+      }
+    }
+  }
+  refs(refPrefix: "refs/heads/", first: 100) {
+    pageInfo {
+      hasNextPage
+    }
+    nodes {
+      name
+    }
+  }
+}
+"""
+REPOS_PER_QUERY = 50
+RETRY_CHUNK_SIZE = 10  # A failed batch is retried once in chunks of this size
+LFS_LABELS = {True: "Yes", False: "No", None: "Unknown"}
+
+# .gitattributes on several branches at once; %s is replaced by aliased selections
+BRANCH_GITATTRIBUTES_QUERY = """
+query($owner: String!, $name: String!) {
+  repository(owner: $owner, name: $name) {
+%s
+  }
+}
+"""
+BRANCHES_PER_QUERY = 50
+PRIORITY_BRANCHES = ("main", "master")
+
+RATE_LIMIT_SAFETY = 10  # Requests to keep in reserve before waiting for the reset
+
+class RateLimiter:
+    """Track GitHub rate-limit headers and wait only when the budget runs low."""
+
+    def __init__(self):
+        self.remaining = None
+        self.reset_at = 0
+        self.cost = 1  # Budget consumed per request; GraphQL reports it per query
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            if self.remaining is None:
+                return
+            if self.remaining < self.cost + RATE_LIMIT_SAFETY:
+                wait_time = self.reset_at - time.time() + 1
+                if wait_time > 0:
+                    print(f"Rate limit nearly exhausted. Sleeping for {wait_time:.0f} seconds...")
+                    time.sleep(wait_time)
+                self.remaining = None
+            else:
+                # Reserve the request's cost so concurrent workers don't overshoot the budget
+                self.remaining -= self.cost
+
+    def update(self, response):
+        remaining = response.headers.get("X-RateLimit-Remaining")
+        reset = response.headers.get("X-RateLimit-Reset")
+        if remaining is not None and reset is not None:
+            with self.lock:
+                self.remaining = int(remaining)
+                self.reset_at = int(reset)
+
+    def update_cost(self, cost):
+        with self.lock:
+            self.cost = max(cost, 1)
+
+# REST and GraphQL have separate budgets
+rest_limiter = RateLimiter()
+graphql_limiter = RateLimiter()
+
+# On-disk cache reused across runs: REST page ETags and per-repository results
+CACHE_FILE = f"{ORG_NAME}_lfs_cache.json"
+cache = {"etags": {}, "repos": {}}
+
+def load_cache():
+    if not os.path.exists(CACHE_FILE):
+        return
+    try:
+        with open(CACHE_FILE, "rb") as f:
+            cache.update(orjson.loads(f.read()))
+    except (OSError, ValueError) as e:
+        print(f"Ignoring unreadable cache '{CACHE_FILE}': {e}")
+
+def save_cache():
+    with open(CACHE_FILE, "wb") as f:
+        f.write(orjson.dumps(cache))
+
+def safe_request(url, payload=None, etag=None):
+    """Perform a GET request, or a POST of the JSON payload, with retry and rate-limit handling."""
+    limiter = rest_limiter if payload is None else graphql_limiter
     for attempt in range(3):
         try:
-            response = session.get(url, headers=HEADERS, timeout=30)
-            if response.status_code == 404:
+            limiter.acquire()
+            if payload is None:
+                response = client.get(url, headers={"If-None-Match": etag} if etag else None)
+            else:
+                response = client.post(url, content=orjson.dumps(payload), headers={"Content-Type": "application/json"})
+            limiter.update(response)
+            if response.status_code in (304, 404):
                 return response
+            if response.status_code in (403, 429):
+                retry_after = response.headers.get("Retry-After")
+                if retry_after is not None:
+                    print(f"Secondary rate limit hit. Retrying in {retry_after} seconds... ({attempt + 1}/3)")
+                    time.sleep(int(retry_after))
+                    continue
+                if response.headers.get("X-RateLimit-Remaining") == "0":
+                    # The limiter now waits for the reset before the next attempt
+                    continue
             response.raise_for_status()
             return response
-        except requests.exceptions.Timeout:
+        except httpx.TimeoutException:
             print(f"Timeout. Retrying... ({attempt + 1}/3)")
             time.sleep(5)
-        except requests.exceptions.ConnectionError:
+        except httpx.NetworkError:
             print(f"Connection error. Retrying... ({attempt + 1}/3)")
             time.sleep(5)
-        except requests.exceptions.RequestException as e:
+        except httpx.HTTPError as e:
             print(f"Request failed: {e}")
             time.sleep(3)
 
     print(f"Failed after 3 attempts: {url}")
     return None
 
+def get_page(url, extract):
+    """GET a REST page and extract its items, reusing the cached items on 304 Not Modified."""
+    cached = cache["etags"].get(url)
+    response = safe_request(url, etag=cached["etag"] if cached else None)
+    if response is None:
+        return None
+    if response.status_code == 304:
+        return cached["items"]
+    if response.status_code != 200:
+        return None
+
+    items = extract(orjson.loads(response.content))
+    etag = response.headers.get("ETag")
+    if etag:
+        cache["etags"][url] = {"etag": etag, "items": items}
+    return items
+
 def get_repositories(org):
     repos = []
     page = 1
     while True:
         url = f"{GHES_URL}/orgs/{org}/repos?per_page=100&page={page}"
-        response = safe_request(url)
-        if not response:
+        data = get_page(url, lambda data: [{"name": repo["name"], "pushed_at": repo["pushed_at"]} for repo in data])
+        if data is None:
             return repos
-
-        data = response.json()
         if not data:
             break
 
         repos.extend(data)
-        if len(repos) % 100 == 0:
-            print("Processed 100 repositories, waiting for 10 seconds...")
-            time.sleep(10)
-
         page += 1
-        time.sleep(1)
 
     return repos
 
 def get_branches(repo_name):
+    """List every branch of a repository, or return None if any page could not be fetched."""
     branches = []
     page = 1
     while True:
         url = f"{GHES_URL}/repos/{ORG_NAME}/{repo_name}/branches?per_page=100&page={page}"
-        response = safe_request(url)
-        if not response:
-            return branches
-
-        data = response.json()
+        data = get_page(url, lambda data: [branch["name"] for branch in data])
+        if data is None:
+            return None
         if not data:
             break
 
-        branches.extend([branch["name"] for branch in data])
+        branches.extend(data)
         page += 1
-        time.sleep(1)
 
     return branches
 
-def check_lfs_usage(repo_name, branch_name):
-    url = f"{GHES_URL}/repos/{ORG_NAME}/{repo_name}/contents/.gitattributes?ref={branch_name}"
-    response = safe_request(url)
-
-    if response:
-        if response.status_code == 404:
-            return False
-        elif response.status_code == 200:
-            try:
-                file_content = response.json().get("content", "")
-                decoded_content = base64.b64decode(file_content).decode("utf-8")
-                if "filter=lfs" in decoded_content:
-                    return True
-            except Exception as e:
-                print(f"Error decoding .gitattributes for {repo_name}: {e}")
-    
-    return False
+def graphql(query, variables):
+    """Run a GraphQL query and return its data, or None on failure."""
+    response = safe_request(GRAPHQL_URL, {"query": query, "variables": variables})
+    if response is None or response.status_code != 200:
+        return None
+
+    result = orjson.loads(response.content)
+    if result.get("errors"):
+        print(f"GraphQL errors: {result['errors']}")
+    data = result.get("data")
+    if data and data.get("rateLimit"):
+        graphql_limiter.update_cost(data["rateLimit"]["cost"])
+    return data
+
+def uses_lfs(text):
+    return text is not None and "filter=lfs" in text
+
+def check_lfs_usage(repo_name, default_ref, branches):
+    """Check .gitattributes on the default branch, falling back to other branches only if it has none.
+
+    default_ref is None only for repositories without a default branch (e.g. empty ones).
+    Returns None when the answer could not be determined because a lookup failed.
+    """
+    default_branch = None
+    if default_ref:
+        default_branch = default_ref["name"]
+        entry = default_ref["target"].get("file")
+        if entry and entry["object"]:
+            return uses_lfs(entry["object"].get("text"))
+
+    if branches is None:
+        return None
+
+    # Probe the usual long-lived branches first so the earliest chunk is the likeliest hit
+    other_branches = sorted(
+        (branch for branch in branches if branch != default_branch),
+        key=lambda branch: branch not in PRIORITY_BRANCHES
+    )
+    failed = False
+    for start in range(0, len(other_branches), BRANCHES_PER_QUERY):
+        chunk = other_branches[start:start + BRANCHES_PER_QUERY]
+        selections = "\n".join(
+            f"    b{i}: object(expression: {orjson.dumps(branch + ':.gitattributes').decode()}) {{ ... on Blob {{ text }} }}"
+            for i, branch in enumerate(chunk)
+        )
+        data = graphql(BRANCH_GITATTRIBUTES_QUERY % selections, {"owner": ORG_NAME, "name": repo_name})
+        if data is None:
+            failed = True
+            continue
+        repository = data.get("repository") or {}
+        if any(uses_lfs((blob or {}).get("text")) for blob in repository.values()):
+            return True
+
+    return None if failed else False
+
+def query_batch(repos):
+    """Run the aliased batch query, retrying once in smaller chunks if it fails.
+
+    Returns repository data keyed by name; repositories that could not be fetched are left out.
+    """
+    selections = "\n".join(
+        f"  r{i}: repository(owner: $owner, name: {orjson.dumps(repo['name']).decode()}) {{ ...LfsDetails }}"
+        for i, repo in enumerate(repos)
+    )
+    data = graphql(REPO_BATCH_QUERY % selections, {"owner": ORG_NAME})
+    if data is not None:
+        return {repo["name"]: data[f"r{i}"] for i, repo in enumerate(repos) if data.get(f"r{i}")}
+    if len(repos) <= RETRY_CHUNK_SIZE:
+        return {}
+
+    print(f"Batch query failed, retrying in chunks of {RETRY_CHUNK_SIZE}...")
+    fetched = {}
+    for start in range(0, len(repos), RETRY_CHUNK_SIZE):
+        fetched.update(query_batch(repos[start:start + RETRY_CHUNK_SIZE]))
+    return fetched
+
+def process_batch(repos):
+    """Fetch branches and LFS usage for a batch of repositories with one aliased query.
+
+    Repositories that have not been pushed to since the last run reuse their cached result.
+    """
+    changed = [
+        repo for repo in repos
+        if repo["name"] not in cache["repos"] or cache["repos"][repo["name"]]["pushed_at"] != repo["pushed_at"]
+    ]
+    fetched = query_batch(changed) if changed else {}
+
+    fresh = {}
+    for repo in changed:
+        repo_name = repo["name"]
+        repository = fetched.get(repo_name)
+        if repository is None:
+            # Still unavailable after the chunked retry: report it as unknown rather than
+            # probing every branch, and leave it uncached so the next run tries again
+            fresh[repo_name] = {"pushed_at": repo["pushed_at"], "branches": [], "lfs_used": LFS_LABELS[None]}
+            continue
+
+        refs = repository["refs"]
+        if refs["pageInfo"]["hasNextPage"]:
+            # More than one page of branches: list them over REST
+            branches = get_branches(repo_name)
+        else:
+            branches = [ref["name"] for ref in refs["nodes"]]
+
+        lfs_used = check_lfs_usage(repo_name, repository["defaultBranchRef"], branches)
+        fresh[repo_name] = {"pushed_at": repo["pushed_at"], "branches": branches or [], "lfs_used": LFS_LABELS[lfs_used]}
+        # Only cache complete results, so a failed lookup is retried on the next run
+        if branches is not None and lfs_used is not None:
+            cache["repos"][repo_name] = fresh[repo_name]
+
+    results = []
+    for repo in repos:
+        entry = fresh.get(repo["name"]) or cache["repos"][repo["name"]]
+        results.append((repo["name"], entry["branches"], entry["lfs_used"]))
+    return results
 
 def main():
+    load_cache()
     repositories = get_repositories(ORG_NAME)
-    results = []
+    csv_filename = f"{ORG_NAME}_lfs_usage.csv"
 
     print(f"\nChecking LFS usage for repositories in {ORG_NAME}")
     print("=" * 90)
     print(f"{'Repository':<30} | {'Branches':<40} | {'Using LFS'}")
     print("-" * 90)
 
-    for index, repo in enumerate(repositories, start=1):
-        repo_name = repo["name"]
-        branches = get_branches(repo_name)
-
-        lfs_used = "No"
-        for branch in branches:
-            if check_lfs_usage(repo_name, branch):
-                lfs_used = "Yes"
-                break
-
-        print(f"{repo_name:<30} | {', '.join(branches):<40} | {lfs_used}")
-        results.append([repo_name, ", ".join(branches), lfs_used])
-
-        if index % 100 == 0:
-            print("Processed 100 repositories, waiting for 10 seconds...")
-            time.sleep(10)
+    with open(csv_filename, "w", newline='', encoding='utf-8', buffering=1 << 20) as f, \
+            ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        writer = csv.writer(f)
+        writer.writerow(["Repository", "Branches", "Using LFS"])
+        batches = [repositories[i:i + REPOS_PER_QUERY] for i in range(0, len(repositories), REPOS_PER_QUERY)]
+        for batch_results in executor.map(process_batch, batches):
+            for repo_name, branches, lfs_used in batch_results:
+                branches_joined = ", ".join(branches)
+                print(f"{repo_name:<30} | {branches_joined:<40} | {lfs_used}")
+                writer.writerow([repo_name, branches_joined, lfs_used])
 
+    save_cache()
     print("=" * 90)
     print("✅ LFS check completed.")
-
-    csv_filename = f"{ORG_NAME}_lfs_usage.csv"
-    df = pd.DataFrame(results, columns=["Repository", "Branches", "Using LFS"])
-    df.to_csv(csv_filename, index=False)
     print(f"📂 Results saved to {csv_filename}")
 
 if __name__ == "__main__":